@@ -4,36 +4,204 @@ Utility functions for olive tree canopy segmentation using Otsu.
 Author: yourself :)
 
 This version uses GDAL/OGR directly for rasterization, avoiding dependency
-on Processing algorithms. It writes the vector layer to a temporary file
-if it's in memory. CRS reprojection and export are handled without using QgsVectorFileWriter.
+on Processing algorithms. Non-shapefile AOI layers are copied into an
+in-memory OGR datasource instead of a temporary file. CRS reprojection
+and export are handled without using QgsVectorFileWriter. Raster pixels
+are read through GDAL windows bounded by the AOI envelope instead of
+decoding the whole image.
+
+OpenCV's SIMD code paths and worker threads are enabled at import time.
+OpenCV 4.5 or newer is recommended: its default connected-components
+algorithm (Spaghetti) is the fast labelling path this module relies on.
 """
 from __future__ import annotations
 
+import functools
+import itertools
+import math
 import os
-import tempfile
-from pathlib import Path
+import struct
+from concurrent.futures import ThreadPoolExecutor
 from typing import Tuple, List, Union
 
 import cv2
 import numpy as np
-from osgeo import gdal, ogr
+from osgeo import gdal, ogr, osr
 from qgis import processing
 from qgis.core import (
     QgsRasterLayer,
     QgsVectorLayer,
     QgsFeature,
     QgsGeometry,
-    QgsPointXY,
     QgsField,
     QgsFillSymbol,
     QgsProject,
     QgsWkbTypes,
 )
 
+# Blobs smaller than this (in pixels) are treated as noise
+MIN_AREA_PX = 10
+# Outlines with more vertices than this are simplified (tolerance in pixels)
+_SIMPLIFY_MIN_VERTICES = 64
+_SIMPLIFY_EPSILON_PX = 0.75
+# Canopies traced per worker task
+_TRACE_CHUNK = 256
+# WKB prefix: little-endian byte order, wkbPolygon (3), one ring
+_WKB_POLYGON_HEADER = struct.pack("<BII", 1, 3, 1)
+
+# QGIS may leave OpenCV single-threaded; keep one core free for the GUI
+cv2.setUseOptimized(True)
+cv2.setNumThreads(max(1, (os.cpu_count() or 1) - 1))
+
 # ---------------------------------------------------------------------
 # HELPERS
 # ---------------------------------------------------------------------
 
+def raster_path(layer_ras: QgsRasterLayer) -> str:
+    """Returns the file path of a raster layer, without provider options."""
+    return layer_ras.source().split("|")[0].split("?")[0]
+
+
+def _read_raster_window(
+    path: str, xoff: int, yoff: int, xsize: int, ysize: int, aoi_mask: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Reads only the given pixel window of the raster as an 8-bit grayscale array.
+
+    Returns the image and `aoi_mask` (0/1) with nodata and NaN pixels
+    removed. Non-8-bit rasters are stretched to 0–255 using the remaining
+    valid AOI pixels only.
+    """
+    ds = gdal.Open(path, gdal.GA_ReadOnly)
+    if ds is None:
+        raise RuntimeError(f"GDAL could not open the raster: {path}")
+
+    valid = aoi_mask.astype(bool)
+    planes: List[np.ndarray] = []
+    for b in (1, 2, 3) if ds.RasterCount >= 3 else (1,):
+        band = ds.GetRasterBand(b)
+        arr = band.ReadAsArray(xoff, yoff, xsize, ysize)
+        if arr is None:
+            raise RuntimeError("GDAL could not read the raster window")
+        nodata = band.GetNoDataValue()
+        if nodata is not None:
+            valid &= arr != nodata
+        if arr.dtype.kind == "f":
+            valid &= np.isfinite(arr)
+        planes.append(arr)
+    ds = None
+
+    if not all(p.dtype == np.uint8 for p in planes):
+        # cvtColor only accepts 8/16-bit integer or float32 input
+        planes = [p.astype(np.float32) for p in planes]
+    if len(planes) == 3:
+        gray = cv2.cvtColor(np.dstack(planes), cv2.COLOR_RGB2GRAY)
+    else:
+        gray = planes[0]
+
+    if gray.dtype == np.uint8:
+        img = gray
+    else:
+        img = np.zeros(gray.shape, dtype=np.uint8)
+        values = gray[valid]
+        if values.size:
+            lo, hi = float(values.min()), float(values.max())
+            scale = 255.0 / (hi - lo) if hi > lo else 0.0
+            img[valid] = np.clip(np.rint((values - lo) * scale), 0, 255).astype(np.uint8)
+    return img, valid.view(np.uint8)
+
+
+def _otsu_threshold(values: np.ndarray) -> int:
+    """Otsu threshold of 8-bit values; pixels <= threshold form the dark class.
+
+    Constant input has no two classes to separate: -1 is returned so that
+    no pixel is classed as dark.
+    """
+    if values.size == 0:
+        raise RuntimeError("The AOI does not cover any raster pixel")
+    hist = np.bincount(values.ravel(), minlength=256).astype(np.float64)
+    if np.count_nonzero(hist) < 2:
+        return -1
+    total = hist.sum()
+    w0 = np.cumsum(hist)
+    w1 = total - w0
+    mu0 = np.cumsum(hist * np.arange(256))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sigma_b2 = (mu0 * total - mu0[-1] * w0) ** 2 / (w0 * w1)
+    sigma_b2[~np.isfinite(sigma_b2)] = 0.0
+    return int(np.argmax(sigma_b2))
+
+
+def _label_canopies(mask_trees: np.ndarray) -> Tuple[int, np.ndarray, np.ndarray]:
+    """Labels canopies (8-connected) after filling their enclosed holes.
+
+    Background regions that do not reach the window border (4-connected)
+    are holes; filling them keeps blobs nested inside a ring-shaped canopy
+    from becoming separate, overlapping features.
+    """
+    n_bg, bg = cv2.connectedComponents(cv2.bitwise_not(mask_trees), connectivity=4)
+    border = np.concatenate((bg[0], bg[-1], bg[:, 0], bg[:, -1]))
+    enclosed = np.ones(n_bg, dtype=bool)
+    enclosed[0] = False  # label 0 is the canopy itself
+    enclosed[border] = False
+    filled = mask_trees.copy()
+    filled[enclosed[bg]] = 255
+
+    n_labels, labels, stats, _ = cv2.connectedComponentsWithStats(
+        filled, 8, cv2.CV_32S
+    )
+    return n_labels, labels, stats
+
+
+def _trace_canopies(
+    labels: np.ndarray,
+    stats: np.ndarray,
+    ids: np.ndarray,
+    xmin: float,
+    ymax: float,
+    px_x: float,
+    px_y: float,
+) -> List[Tuple[int, bytes]]:
+    """Traces the outline of each labelled canopy and maps it to map coordinates.
+
+    Returns ``(area_px, wkb)`` pairs, ``wkb`` being a little-endian WKB polygon.
+    Uses only OpenCV/NumPy so it is safe to run in a worker thread.
+    """
+    kept: List[Tuple[int, np.ndarray]] = []
+    for i in ids.tolist():
+        left, top, width, height, area_px = (int(v) for v in stats[i])
+        # Trace the outline only inside the component's bounding box
+        roi = (labels[top:top + height, left:left + width] == i).astype(np.uint8)
+        contornos, _ = cv2.findContours(
+            roi, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_TC89_KCOS, offset=(left, top)
+        )
+        cnt = max(contornos, key=len)
+        if cnt.shape[0] > _SIMPLIFY_MIN_VERTICES:
+            cnt = cv2.approxPolyDP(cnt, _SIMPLIFY_EPSILON_PX, True)
+        if cnt.shape[0] < 3:
+            continue
+        pts = cnt[:, 0, :]
+        kept.append((area_px, np.vstack((pts, pts[:1]))))  # closed ring
+    if not kept:
+        return []
+
+    # One affine pass over all vertices of the chunk (pixel centres → map)
+    pix = np.concatenate([cnt for _, cnt in kept]).astype(np.float64)
+    scale = np.array([px_x, -px_y])
+    origin = np.array([xmin + 0.5 * px_x, ymax - 0.5 * px_y])
+    coords = pix * scale + origin
+    rings = np.split(coords, np.cumsum([len(cnt) for _, cnt in kept])[:-1])
+    return [(area_px, _ring_to_wkb(ring)) for (area_px, _), ring in zip(kept, rings)]
+
+
+def _ring_to_wkb(ring: np.ndarray) -> bytes:
+    """Serializes a closed Nx2 coordinate ring as a single-ring WKB polygon."""
+    return (
+        _WKB_POLYGON_HEADER
+        + struct.pack("<I", len(ring))
+        + ring.astype("<f8", copy=False).tobytes()
+    )
+
+
 def _load_layer_from_output(output: Union[str, QgsVectorLayer]) -> QgsVectorLayer:
     """If output is a path, load layer; if it's already a layer, return it as is."""
     if isinstance(output, QgsVectorLayer):
@@ -61,53 +229,40 @@ def _reproject_aoi_to_raster(aoi: QgsVectorLayer, ras: QgsRasterLayer) -> QgsVec
     return _load_layer_from_output(out)
 
 
-def _prepare_aoi_file(aoi: QgsVectorLayer) -> str:
-    """If the AOI is in memory, save it to a temporary shapefile and return path."""
+def _open_aoi_ogr(aoi: QgsVectorLayer, proj_wkt: str) -> ogr.DataSource:
+    """Opens the AOI with OGR; non-shapefile layers are copied into an OGR memory datasource."""
     source = aoi.dataProvider().dataSourceUri()
     if source.lower().endswith(".shp"):
-        return source
-
-    tmp_dir = Path(tempfile.mkdtemp())
-    shp_path = tmp_dir / "aoi_temp.shp"
-    result = processing.run(
-        "native:savefeatures",
-        {"INPUT": aoi, "OUTPUT": str(shp_path)},
-        is_child_algorithm=True
-    )
-    shp_result = result.get("OUTPUT")
-    if not shp_result or not Path(shp_result).exists():
-        raise RuntimeError("Failed to write temporary AOI shapefile")
-    return shp_result
+        src_ds = ogr.Open(source)
+        if src_ds is None:
+            raise RuntimeError("Failed to open AOI layer with OGR")
+        return src_ds
 
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(proj_wkt)
+    src_ds = ogr.GetDriverByName("Memory").CreateDataSource("aoi")
+    ogr_layer = src_ds.CreateLayer("aoi", srs=srs, geom_type=ogr.wkbUnknown)
+    defn = ogr_layer.GetLayerDefn()
+    for feat in aoi.getFeatures():
+        geom = feat.geometry()
+        if geom.isNull():
+            continue
+        ogr_feat = ogr.Feature(defn)
+        ogr_feat.SetGeometry(ogr.CreateGeometryFromWkb(bytes(geom.asWkb())))
+        ogr_layer.CreateFeature(ogr_feat)
+    return src_ds
 
-def _rasterize_aoi(
-    layer_aoi: QgsVectorLayer, layer_ras: QgsRasterLayer
-) -> Tuple[np.ndarray, float, float, float, float, int, int]:
-    """Rasterizes the AOI reprojected to the raster CRS and returns the mask + metadata."""
-    aoi_proj = _reproject_aoi_to_raster(layer_aoi, layer_ras)
-
-    aoi_file = _prepare_aoi_file(aoi_proj)
-    
-    extent = layer_ras.extent()
-    w, h = layer_ras.width(), layer_ras.height()
-    gt = (
-        extent.xMinimum(),
-        (extent.xMaximum() - extent.xMinimum()) / w,
-        0,
-        extent.yMaximum(),
-        0,
-        -(extent.yMaximum() - extent.yMinimum()) / h,
-    )
 
+def _burn_aoi_gdal(
+    aoi: QgsVectorLayer, gt: Tuple[float, ...], proj_wkt: str, win_w: int, win_h: int
+) -> np.ndarray:
+    """Burns the AOI into a 0/1 mask with gdal.RasterizeLayer."""
     mem_driver = gdal.GetDriverByName("MEM")
-    dst_ds = mem_driver.Create("", w, h, 1, gdal.GDT_Byte)
+    dst_ds = mem_driver.Create("", win_w, win_h, 1, gdal.GDT_Byte)
     dst_ds.SetGeoTransform(gt)
-    proj_wkt = layer_ras.crs().toWkt()
     dst_ds.SetProjection(proj_wkt)
 
-    src_ds = ogr.Open(aoi_file)
-    if src_ds is None:
-        raise RuntimeError("Failed to open AOI layer with OGR")
+    src_ds = _open_aoi_ogr(aoi, proj_wkt)
     ogr_layer = src_ds.GetLayer()
 
     err = gdal.RasterizeLayer(dst_ds, [1], ogr_layer, burn_values=[1])
@@ -115,59 +270,126 @@ def _rasterize_aoi(
     if err != 0:
         raise RuntimeError("GDAL RasterizeLayer error")
 
+    # Band is already 0/1 uint8 (GDT_Byte, burn value 1)
     mask_arr = dst_ds.GetRasterBand(1).ReadAsArray()
-    px_x = gt[1]
-    px_y = abs(gt[5])
     dst_ds = None
+    return mask_arr
 
-    mask_arr = (mask_arr > 0).astype(np.uint8)
-    return mask_arr, extent, px_x, px_y, w, h
+
+def _rasterize_aoi(
+    layer_aoi: QgsVectorLayer, layer_ras: QgsRasterLayer
+) -> Tuple[np.ndarray, Tuple[int, int, int, int], float, float, float, float]:
+    """Rasterizes the AOI over its pixel envelope in the raster.
+
+    Returns the mask, the raster window ``(xoff, yoff, xsize, ysize)`` it
+    covers, the geographic origin of that window and the pixel size.
+    """
+    aoi_proj = _reproject_aoi_to_raster(layer_aoi, layer_ras)
+
+    extent = layer_ras.extent()
+    w, h = layer_ras.width(), layer_ras.height()
+    px_x = extent.width() / w
+    px_y = extent.height() / h
+
+    # AOI envelope in raster pixel coordinates, clipped to the raster
+    env = aoi_proj.extent()
+    col0 = max(0, math.floor((env.xMinimum() - extent.xMinimum()) / px_x))
+    col1 = min(w, math.ceil((env.xMaximum() - extent.xMinimum()) / px_x))
+    row0 = max(0, math.floor((extent.yMaximum() - env.yMaximum()) / px_y))
+    row1 = min(h, math.ceil((extent.yMaximum() - env.yMinimum()) / px_y))
+    if col1 <= col0 or row1 <= row0:
+        raise RuntimeError("The AOI does not overlap the raster")
+    win_w, win_h = col1 - col0, row1 - row0
+
+    xmin = extent.xMinimum() + col0 * px_x
+    ymax = extent.yMaximum() - row0 * px_y
+    gt = (xmin, px_x, 0, ymax, 0, -px_y)
+
+    mask_arr = _burn_aoi_gdal(aoi_proj, gt, layer_ras.crs().toWkt(), win_w, win_h)
+
+    return mask_arr, (col0, row0, win_w, win_h), xmin, ymax, px_x, px_y
 
 
 # ---------------------------------------------------------------------
 # MAIN FUNCTION
 # ---------------------------------------------------------------------
 
-def segment_olivos(layer_ras: QgsRasterLayer, layer_aoi: QgsVectorLayer) -> QgsVectorLayer:
-    """Generates temporary layer with segmented canopies – handles mixed CRS."""
-    mask_arr, extent, px_x, px_y, w, h = _rasterize_aoi(layer_aoi, layer_ras)
-
-    raster_path = layer_ras.source().split("|")[0].split("?")[0]
-    img_gray = cv2.imread(raster_path, cv2.IMREAD_GRAYSCALE)
-    if img_gray is None:
-        raise RuntimeError("OpenCV could not read the raster (grayscale)")
+def segment_olivos(
+    layer_ras: QgsRasterLayer,
+    layer_aoi: QgsVectorLayer,
+    min_area_px: int = MIN_AREA_PX,
+) -> QgsVectorLayer:
+    """Generates temporary layer with segmented canopies – handles mixed CRS.
 
-    _, otsu_full = cv2.threshold(img_gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-    bin_img = np.zeros_like(otsu_full, dtype=np.uint8)
-    bin_img[mask_arr == 1] = otsu_full[mask_arr == 1]
+    Only the raster window covering the AOI envelope is read from disk.
+    Canopies smaller than `min_area_px` pixels are discarded and the rest
+    are added largest first.
+    """
+    mask_arr, window, xmin, ymax, px_x, px_y = _rasterize_aoi(layer_aoi, layer_ras)
 
-    mask_trees = np.zeros_like(bin_img, dtype=np.uint8)
-    mask_trees[np.logical_and(mask_arr == 1, bin_img == 0)] = 255
+    # Shrink the window to the rows/columns actually burnt by the AOI
+    rows = np.flatnonzero(mask_arr.any(axis=1))
+    cols = np.flatnonzero(mask_arr.any(axis=0))
+    if rows.size == 0:
+        raise RuntimeError("The AOI does not cover any raster pixel")
+    r0, r1 = int(rows[0]), int(rows[-1]) + 1
+    c0, c1 = int(cols[0]), int(cols[-1]) + 1
+    mask_arr = np.ascontiguousarray(mask_arr[r0:r1, c0:c1])
+    xoff, yoff = window[0] + c0, window[1] + r0
+    xmin += c0 * px_x
+    ymax -= r0 * px_y
 
-    contornos, _ = cv2.findContours(
-        mask_trees, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
+    # Nodata pixels are dropped from the AOI mask
+    img_gray, mask_arr = _read_raster_window(
+        raster_path(layer_ras), xoff, yoff, c1 - c0, r1 - r0, mask_arr
     )
 
+    # Otsu threshold from the AOI pixels only (mask is 0/1, so view it as bool)
+    t = _otsu_threshold(img_gray[mask_arr.view(bool)])
+
+    # Dark pixels inside the AOI are canopy (0/255); both ops are SIMD in OpenCV
+    _, dark = cv2.threshold(img_gray, t, 255, cv2.THRESH_BINARY_INV)
+    mask_trees = cv2.bitwise_and(dark, dark, mask=mask_arr)
+
+    n_labels, labels, stats = _label_canopies(mask_trees)
+
     vlayer = QgsVectorLayer(f"Polygon?crs={layer_ras.crs().authid()}", "Olive_Canopies", "memory")
     prov = vlayer.dataProvider()
     prov.addAttributes([QgsField("ID", 4), QgsField("Area_px", 4)])
     vlayer.updateFields()
 
-    for i, cnt in enumerate(contornos, start=1):
-        if cnt.shape[0] < 3:
-            continue
-        area_px = int(cv2.contourArea(cnt))
-        pts: List[QgsPointXY] = []
-        for pt in cnt[:, 0, :]:
-            px, py = int(pt[0]), int(pt[1])
-            x_geo = extent.xMinimum() + (px + 0.5) * px_x
-            y_geo = extent.yMaximum() - (py + 0.5) * px_y
-            pts.append(QgsPointXY(x_geo, y_geo))
+    # Drop small blobs before any per-canopy work, largest canopies first
+    areas = stats[1:, cv2.CC_STAT_AREA]
+    keep = np.flatnonzero(areas >= min_area_px)
+    keep = keep[np.argsort(-areas[keep], kind="stable")] + 1
+
+    # Outlines are traced in worker threads (OpenCV/NumPy release the GIL);
+    # QGIS objects are only created here, on the calling thread
+    chunks = [keep[k:k + _TRACE_CHUNK] for k in range(0, len(keep), _TRACE_CHUNK)]
+    trace = functools.partial(
+        _trace_canopies, labels, stats, xmin=xmin, ymax=ymax, px_x=px_x, px_y=px_y
+    )
+    with ThreadPoolExecutor() as pool:
+        traced = list(pool.map(trace, chunks))
+
+    # Features are collected first and handed to the provider in one batch
+    feats: List[QgsFeature | None] = [None] * len(keep)
+    n_feats = 0
+    for area_px, wkb in itertools.chain.from_iterable(traced):
+        geom = QgsGeometry()
+        geom.fromWkb(wkb)
         feat = QgsFeature()
-        feat.setGeometry(QgsGeometry.fromPolygonXY([pts]))
-        feat.setAttributes([i, area_px])
-        prov.addFeature(feat)
+        feat.setGeometry(geom)
+        n_feats += 1
+        feat.setAttributes([n_feats, area_px])
+        feats[n_feats - 1] = feat
+    del feats[n_feats:]
 
+    vlayer.blockSignals(True)
+    try:
+        prov.addFeatures(feats)
+    finally:
+        vlayer.blockSignals(False)
     vlayer.updateExtents()
     symbol = QgsFillSymbol.createSimple(
         {"color": "0,255,0,120", "outline_color": "0,100,0", "outline_width": "0.3"}
@@ -15,7 +15,7 @@ from __future__ import annotations
 from pathlib import Path
 from typing import List, Tuple
 
-import cv2
+from osgeo import gdal
 from qgis.PyQt import QtWidgets, uic
 from qgis.PyQt.QtCore import QTimer
 from qgis.PyQt.QtWidgets import QMessageBox
@@ -30,11 +30,12 @@ from qgis.core import (
 from qgis.utils import iface
 
 from .pixel_picker_tool import PixelPickerTool
-from .otsu_segmentation import segment_olivos
+from .otsu_segmentation import MIN_AREA_PX, raster_path, segment_olivos
 
 # -------------------------------------------------------------------
 _FORM, _ = uic.loadUiType(Path(__file__).with_name("segmentador_olivos_dialog_base.ui"))
 _CLOSE_DELAY_MS = 2000
+_REFRESH_DELAY_MS = 50
 Sample = Tuple[float, float, List[int]]
 
 
@@ -46,35 +47,51 @@ class SegmentadorOlivosDialog(QtWidgets.QDialog, _FORM):
         self.pixelTool: PixelPickerTool | None = None
         self.canvas = iface.mapCanvas()
         self.muestras: List[Sample] = []
+        # GDAL handle kept open while sampling (one band per R, G, B)
+        self._sampling = False
+        self._ds: gdal.Dataset | None = None
+        self._bands: Tuple[gdal.Band, ...] = ()
+        # Canvas → raster CRS transform and map → pixel affine, per sampling run
+        self._tr: QgsCoordinateTransform | None = None
+        self._ras_crs = QgsCoordinateReferenceSystem()
+        self._xmin = self._ymax = 0.0
+        self._inv_px_x = self._inv_px_y = 0.0
 
         self._fill_combos()
         self._toggle_sample_button()
 
         # Connections --------------------------------------------------
         self.comboRaster.currentIndexChanged.connect(self._toggle_sample_button)
+        self.comboRaster.currentIndexChanged.connect(self._on_raster_changed)
         self.btnIniciarMuestras.clicked.connect(self._start_sampling)
         self.btnTerminarMuestras.clicked.connect(self._stop_sampling)
         self.buttonBox.accepted.connect(self.segmentar_con_otsu)
 
-        # Listen to project changes
+        # Listen to project changes (debounced: bulk loads rebuild combos once)
+        self._refresh_timer = QTimer(self)
+        self._refresh_timer.setSingleShot(True)
+        self._refresh_timer.timeout.connect(self._refresh_combos)
         self._prj = QgsProject.instance()
         self._prj.layerWasAdded.connect(self._on_layers_changed)
         self._prj.layerWillBeRemoved.connect(self._on_layers_changed)
 
         # Initial UI state ---------------------------------------------
         self.progressBar.setValue(0)
+        self.spinMinArea.setValue(MIN_AREA_PX)
         self.labelEstado.setText("Select AOI (.shp) and raster (.tif/.tiff)")
         self.btnTerminarMuestras.setEnabled(False)
 
     # ----- dynamic combo update --------------------------------------
     def _on_layers_changed(self, *_):
+        self._refresh_timer.start(_REFRESH_DELAY_MS)
+
+    def _refresh_combos(self):
         self._fill_combos()
         self._toggle_sample_button()
 
     def showEvent(self, e):
         super().showEvent(e)
-        self._fill_combos()
-        self._toggle_sample_button()
+        self._refresh_combos()
 
     # ----------------------------------------------------------------
     # combo / button helpers
@@ -98,10 +115,58 @@ class SegmentadorOlivosDialog(QtWidgets.QDialog, _FORM):
     def _toggle_sample_button(self, *_):
         self.btnIniciarMuestras.setEnabled(self.comboRaster.count() > 0)
 
+    def _on_raster_changed(self, *_):
+        # Keep sampling on the newly selected raster (combo rebuilds pass
+        # through index -1 first, so this runs again once an item is set)
+        if self._sampling:
+            self._open_sampling_raster()
+
     # ----------------------------------------------------------------
     # Sample collection
     # ----------------------------------------------------------------
+    def _open_sampling_raster(self) -> bool:
+        self._release_sampling_raster()
+        layer_ras: QgsRasterLayer | None = self.comboRaster.currentData()
+        if not isinstance(layer_ras, QgsRasterLayer):
+            return False
+        ds = gdal.Open(raster_path(layer_ras), gdal.GA_ReadOnly)
+        if ds is None:
+            QMessageBox.warning(self, "Error", "Unable to open raster with GDAL.")
+            return False
+        # Grayscale rasters repeat band 1
+        band_ids = (1, 2, 3) if ds.RasterCount >= 3 else (1, 1, 1)
+        self._ds = ds
+        self._bands = tuple(ds.GetRasterBand(b) for b in band_ids)
+
+        # Follow canvas CRS changes while the handle is open
+        self._ras_crs = layer_ras.crs()
+        self._update_transform()
+        self.canvas.destinationCrsChanged.connect(self._update_transform)
+
+        ext = layer_ras.extent()
+        self._xmin, self._ymax = ext.xMinimum(), ext.yMaximum()
+        self._inv_px_x = layer_ras.width() / ext.width()
+        self._inv_px_y = layer_ras.height() / ext.height()
+        return True
+
+    def _update_transform(self):
+        src_crs = self.canvas.mapSettings().destinationCrs()
+        self._tr = (
+            QgsCoordinateTransform(src_crs, self._ras_crs, QgsProject.instance())
+            if src_crs != self._ras_crs else None
+        )
+
+    def _release_sampling_raster(self):
+        if self._ds is not None:
+            self.canvas.destinationCrsChanged.disconnect(self._update_transform)
+        self._bands = ()
+        self._ds = None
+        self._tr = None
+
     def _start_sampling(self):
+        if not self._open_sampling_raster():
+            return
+        self._sampling = True
         self.pixelTool = PixelPickerTool(self.canvas, self._handle_pixel_click)
         self.canvas.setMapTool(self.pixelTool)
         self.btnIniciarMuestras.setEnabled(False)
@@ -110,35 +175,28 @@ class SegmentadorOlivosDialog(QtWidgets.QDialog, _FORM):
         self.labelEstado.setText("Samples collected: 0")
 
     def _handle_pixel_click(self, x_geo: float, y_geo: float):
-        layer_ras: QgsRasterLayer | None = self.comboRaster.currentData()
-        if not isinstance(layer_ras, QgsRasterLayer):
+        if self._ds is None:
             return
 
         # — Transform to raster CRS if different —
-        dst_crs = layer_ras.crs()
-        src_crs = self.canvas.mapSettings().destinationCrs()
-        if src_crs != dst_crs:
-            tr = QgsCoordinateTransform(src_crs, dst_crs, QgsProject.instance())
-            pt = tr.transform(x_geo, y_geo)
+        if self._tr is not None:
+            pt = self._tr.transform(x_geo, y_geo)
             x_geo, y_geo = pt.x(), pt.y()
 
-        img = cv2.imread(layer_ras.source().split("|")[0], cv2.IMREAD_COLOR)
-        if img is None:
-            QMessageBox.warning(self, "Error", "Unable to open raster with OpenCV.")
-            return
-
-        ext = layer_ras.extent()
-        col = int((x_geo - ext.xMinimum()) / (ext.width() / layer_ras.width()))
-        row = int((ext.yMaximum() - y_geo) / (ext.height() / layer_ras.height()))
-        if 0 <= row < img.shape[0] and 0 <= col < img.shape[1]:
-            b, g, r = img[row, col]
-            self.muestras.append((x_geo, y_geo, [int(r), int(g), int(b)]))
+        col = int((x_geo - self._xmin) * self._inv_px_x)
+        row = int((self._ymax - y_geo) * self._inv_px_y)
+        if 0 <= row < self._ds.RasterYSize and 0 <= col < self._ds.RasterXSize:
+            # Read only the clicked pixel
+            rgb = [int(band.ReadAsArray(col, row, 1, 1)[0, 0]) for band in self._bands]
+            self.muestras.append((x_geo, y_geo, rgb))
             self.labelEstado.setText(f"Samples collected: {len(self.muestras)}")
 
     def _stop_sampling(self):
         if self.pixelTool:
             self.canvas.unsetMapTool(self.pixelTool)
             self.pixelTool.resetRubberBand()
+        self._sampling = False
+        self._release_sampling_raster()
         self.btnTerminarMuestras.setEnabled(False)
         self._toggle_sample_button()
         self.labelEstado.setText(
@@ -155,7 +213,7 @@ class SegmentadorOlivosDialog(QtWidgets.QDialog, _FORM):
             QMessageBox.warning(self, "Error", "You must select valid AOI and raster.")
             return
         try:
-            vlayer = segment_olivos(layer_ras, layer_aoi)
+            vlayer = segment_olivos(layer_ras, layer_aoi, self.spinMinArea.value())
         except Exception as exc:  # noqa: BLE001
             QMessageBox.critical(self, "Segmentation failed", str(exc))
             return
@@ -171,10 +229,18 @@ class SegmentadorOlivosDialog(QtWidgets.QDialog, _FORM):
     # ----------------------------------------------------------------
     # Disconnect signals
     # ----------------------------------------------------------------
+    def done(self, r):
+        # accept()/reject() do not go through closeEvent
+        self._sampling = False
+        self._release_sampling_raster()
+        super().done(r)
+
     def closeEvent(self, e):  # noqa: D401
         try:
             self._prj.layerWasAdded.disconnect(self._on_layers_changed)
             self._prj.layerWillBeRemoved.disconnect(self._on_layers_changed)
         except Exception:
             pass
+        self._refresh_timer.stop()
+        self._release_sampling_raster()
         super().closeEvent(e)
@@ -0,0 +1,261 @@
+# coding=utf-8
+"""Otsu segmentation helpers test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'cristianquevedoagro@gmail.com'
+__date__ = '2025-06-03'
+__copyright__ = 'Copyright 2025, Cristian AI Agro'
+
+import unittest
+
+import cv2
+import numpy as np
+from osgeo import gdal, ogr
+
+from utilities import get_qgis_app
+QGIS_APP = get_qgis_app()
+
+from otsu_segmentation import (
+    _label_canopies,
+    _otsu_threshold,
+    _read_raster_window,
+    _ring_to_wkb,
+    _trace_canopies,
+)
+
+
+def _cv2_otsu(values):
+    """Threshold picked by OpenCV's own Otsu implementation."""
+    t, _ = cv2.threshold(
+        values.reshape(1, -1), 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU
+    )
+    return int(t)
+
+
+class OtsuThresholdTest(unittest.TestCase):
+    """Test the AOI-only Otsu threshold matches OpenCV."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.rng = np.random.default_rng(42)
+
+    def test_bimodal_matches_opencv(self):
+        """Two overlapping modes (dark canopy, bright soil)."""
+        values = np.concatenate([
+            self.rng.normal(70, 20, 40000),
+            self.rng.normal(180, 25, 60000),
+        ])
+        values = np.clip(values, 0, 255).astype(np.uint8)
+        self.assertEqual(_otsu_threshold(values), _cv2_otsu(values))
+
+    def test_skewed_matches_opencv(self):
+        """A single skewed distribution with a long bright tail."""
+        values = np.clip(self.rng.gamma(2.0, 30.0, 100000), 0, 255).astype(np.uint8)
+        self.assertEqual(_otsu_threshold(values), _cv2_otsu(values))
+
+    def test_constant_has_no_dark_class(self):
+        """Constant input returns -1, so no pixel is canopy."""
+        for value in (0, 128, 255):
+            values = np.full(1000, value, dtype=np.uint8)
+            t = _otsu_threshold(values)
+            self.assertEqual(t, -1)
+            _, dark = cv2.threshold(
+                values.reshape(1, -1), t, 255, cv2.THRESH_BINARY_INV
+            )
+            self.assertFalse(dark.any())
+
+    def test_empty_raises(self):
+        """An AOI without pixels is an error."""
+        with self.assertRaises(RuntimeError):
+            _otsu_threshold(np.empty(0, dtype=np.uint8))
+
+
+class TraceCanopiesTest(unittest.TestCase):
+    """Test canopy outlines map to the right pixel centres."""
+
+    XMIN, YMAX, PX_X, PX_Y = 1000.0, 2000.0, 0.5, 0.25
+
+    def setUp(self):
+        """Runs before each test."""
+        mask = np.zeros((80, 80), dtype=np.uint8)
+        mask[2:6, 3:7] = 255      # label 1: 4x4 square
+        mask[10:13, 9:15] = 255   # label 2: 3x6 rectangle
+        cv2.circle(mask, (45, 50), 25, 255, -1)  # label 3: large disc
+        _, self.labels, self.stats = cv2.connectedComponentsWithStats(
+            mask, 8, cv2.CV_32S
+        )
+
+    def _trace(self, ids):
+        return _trace_canopies(
+            self.labels, self.stats, np.array(ids),
+            self.XMIN, self.YMAX, self.PX_X, self.PX_Y,
+        )
+
+    def _ring(self, wkb):
+        geom = ogr.CreateGeometryFromWkb(wkb)
+        self.assertEqual(geom.GetGeometryType(), ogr.wkbPolygon)
+        return geom, np.array(geom.GetGeometryRef(0).GetPoints())
+
+    def _assert_ring_on_label(self, ring, label):
+        """Every vertex is the centre of a pixel of `label`; ring is closed."""
+        np.testing.assert_array_equal(ring[0], ring[-1])
+        cols = (ring[:, 0] - self.XMIN) / self.PX_X - 0.5
+        rows = (self.YMAX - ring[:, 1]) / self.PX_Y - 0.5
+        np.testing.assert_array_equal(cols, np.round(cols))
+        np.testing.assert_array_equal(rows, np.round(rows))
+        hits = self.labels[rows.astype(int), cols.astype(int)]
+        self.assertTrue((hits == label).all())
+
+    def test_rectangles_in_one_chunk(self):
+        """Several labels per chunk keep their own rings, in `ids` order."""
+        traced = self._trace([2, 1, 3])
+        disc_area = int(self.stats[3, cv2.CC_STAT_AREA])
+        self.assertEqual([area for area, _ in traced], [18, 16, disc_area])
+
+        for (_, wkb), label, (r0, r1, c0, c1) in zip(
+            traced[:2], (2, 1), ((10, 12, 9, 14), (2, 5, 3, 6))
+        ):
+            geom, ring = self._ring(wkb)
+            self._assert_ring_on_label(ring, label)
+            env = geom.GetEnvelope()  # (minX, maxX, minY, maxY)
+            self.assertAlmostEqual(env[0], self.XMIN + (c0 + 0.5) * self.PX_X)
+            self.assertAlmostEqual(env[1], self.XMIN + (c1 + 0.5) * self.PX_X)
+            self.assertAlmostEqual(env[2], self.YMAX - (r1 + 0.5) * self.PX_Y)
+            self.assertAlmostEqual(env[3], self.YMAX - (r0 + 0.5) * self.PX_Y)
+            self.assertAlmostEqual(
+                geom.GetArea(), (c1 - c0) * self.PX_X * (r1 - r0) * self.PX_Y
+            )
+
+    def test_simplified_disc_keeps_boundary_vertices(self):
+        """Simplified outlines only keep original pixel-centre vertices."""
+        (_, wkb), = self._trace([3])
+        _, ring = self._ring(wkb)
+        self._assert_ring_on_label(ring, 3)
+        self.assertGreater(len(ring), 4)
+
+
+class RingToWkbTest(unittest.TestCase):
+    """Test canopy rings serialize to valid WKB polygons."""
+
+    def test_round_trip_through_ogr(self):
+        """OGR reads back the same closed ring, byte for byte."""
+        ring = np.array([
+            [500000.25, 4200000.75],
+            [500010.25, 4200000.75],
+            [500010.25, 4199990.75],
+            [500000.25, 4199990.75],
+            [500000.25, 4200000.75],
+        ])
+        wkb = _ring_to_wkb(ring)
+        geom = ogr.CreateGeometryFromWkb(wkb)
+        self.assertIsNotNone(geom)
+        self.assertEqual(geom.GetGeometryType(), ogr.wkbPolygon)
+        self.assertEqual(geom.GetGeometryCount(), 1)
+        self.assertEqual(geom.GetGeometryRef(0).GetPoints(), [tuple(p) for p in ring.tolist()])
+        self.assertAlmostEqual(geom.GetArea(), 100.0)
+        self.assertEqual(bytes(geom.ExportToWkb(ogr.wkbNDR)), wkb)
+
+
+def _write_raster(path, planes, gdal_type, nodata):
+    """Writes same-shaped planes as a GeoTIFF (e.g. under /vsimem/)."""
+    rows, cols = planes[0].shape
+    ds = gdal.GetDriverByName("GTiff").Create(path, cols, rows, len(planes), gdal_type)
+    for b, plane in enumerate(planes, start=1):
+        band = ds.GetRasterBand(b)
+        band.SetNoDataValue(nodata)
+        band.WriteArray(plane)
+    ds = None
+
+
+class ReadRasterWindowTest(unittest.TestCase):
+    """Test windowed reads of non-8-bit rasters with nodata."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.path = "/vsimem/test_read_raster_window.tif"
+        # AOI covers the first four columns only
+        self.aoi = np.zeros((4, 5), dtype=np.uint8)
+        self.aoi[:, :4] = 1
+
+    def tearDown(self):
+        """Runs after each test."""
+        gdal.Unlink(self.path)
+
+    def test_float_rgb_nodata_and_nan(self):
+        """Nodata/NaN leave the mask; the stretch ignores them and out-of-AOI pixels."""
+        plane = (np.arange(20, dtype=np.float32).reshape(4, 5) * 10) + 10
+        plane[0, 0] = -10000   # nodata
+        plane[1, 1] = np.nan
+        plane[2, 4] = 1e6      # outside the AOI
+        _write_raster(self.path, [plane] * 3, gdal.GDT_Float32, -10000)
+
+        img, mask = _read_raster_window(self.path, 0, 0, 5, 4, self.aoi)
+
+        expected = self.aoi.copy()
+        expected[0, 0] = 0
+        expected[1, 1] = 0
+        np.testing.assert_array_equal(mask, expected)
+        valid = img[mask.view(bool)]
+        self.assertEqual(int(valid.min()), 0)    # plane[0, 1] == 20
+        self.assertEqual(int(valid.max()), 255)  # plane[3, 3] == 190
+        self.assertEqual(int(img[0, 1]), 0)
+        self.assertEqual(int(img[3, 3]), 255)
+
+    def test_int16_rgb(self):
+        """int16 RGB bands are promoted before the grayscale conversion."""
+        base = np.arange(20, dtype=np.int16).reshape(4, 5) * 100
+        base[2, 2] = -1  # nodata
+        planes = [base, base + 50, base + 100]
+        _write_raster(self.path, planes, gdal.GDT_Int16, -1)
+
+        img, mask = _read_raster_window(self.path, 0, 0, 5, 4, self.aoi)
+
+        self.assertEqual(img.dtype, np.uint8)
+        expected = self.aoi.copy()
+        expected[2, 2] = 0
+        np.testing.assert_array_equal(mask, expected)
+        valid = img[mask.view(bool)]
+        self.assertEqual(int(valid.min()), 0)
+        self.assertEqual(int(valid.max()), 255)
+
+
+class LabelCanopiesTest(unittest.TestCase):
+    """Test canopy labelling of nested blobs."""
+
+    def test_blob_inside_ring_is_not_a_separate_canopy(self):
+        """A blob in the hole of a ring-shaped canopy merges into it."""
+        mask = np.zeros((20, 20), dtype=np.uint8)
+        mask[3:15, 3:15] = 255  # ring: 12x12 square ...
+        mask[6:12, 6:12] = 0    # ... with a 6x6 hole
+        mask[8:10, 8:10] = 255  # 2x2 blob inside the hole
+        n_labels, labels, stats = _label_canopies(mask)
+        self.assertEqual(n_labels, 2)
+        self.assertEqual(int(stats[1, cv2.CC_STAT_AREA]), 12 * 12)
+        self.assertEqual(int(labels[8, 8]), 1)
+
+    def test_separate_blobs_stay_separate(self):
+        """Background open to the window border is not filled."""
+        mask = np.zeros((20, 20), dtype=np.uint8)
+        mask[2:6, 2:6] = 255
+        mask[10:14, 10:14] = 255
+        n_labels, _, stats = _label_canopies(mask)
+        self.assertEqual(n_labels, 3)
+        self.assertEqual(stats[1:, cv2.CC_STAT_AREA].tolist(), [16, 16])
+
+
+if __name__ == "__main__":
+    suite = unittest.TestSuite([
+        unittest.makeSuite(OtsuThresholdTest),
+        unittest.makeSuite(ReadRasterWindowTest),
+        unittest.makeSuite(LabelCanopiesTest),
+        unittest.makeSuite(TraceCanopiesTest),
+        unittest.makeSuite(RingToWkbTest),
+    ])
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)